@@ -10,6 +10,31 @@ BASE_DIR = op.dirname(op.realpath(__file__))
 # the directory where you want to store the source images (if using FILESYSTEM storage)
 STORAGE_DIRECTORY = os.path.join(BASE_DIR, 'storage')
 
+# number of manipulated images kept in memory (0 disables the cache)
+MANIPULATED_IMAGE_CACHE_SIZE = int(os.environ.get('MANIPULATED_IMAGE_CACHE_SIZE', 128))
+
+# number of original images kept in memory to manipulate them (0 disables the cache)
+SOURCE_IMAGE_CACHE_SIZE = int(os.environ.get('SOURCE_IMAGE_CACHE_SIZE', 16))
+# originals larger than this (in bytes) are not kept in that cache
+SOURCE_IMAGE_CACHE_MAX_FILE_SIZE = int(os.environ.get('SOURCE_IMAGE_CACHE_MAX_FILE_SIZE', 8 * 1024 * 1024))
+# fill that cache with the most recently changed originals when the app starts
+PRELOAD_SOURCE_IMAGES = os.environ.get('PRELOAD_SOURCE_IMAGES', 'False') == 'True'
+
+# uploads with more pixels (width * height) are rejected
+MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS', 50000000))
+
+# seconds clients (and proxies) may cache images
+SEND_FILE_MAX_AGE_DEFAULT = int(os.environ.get('SEND_FILE_MAX_AGE_DEFAULT', 86400))
+
+# file extensions allowed for uploaded images
+ALLOWED_EXTENSIONS = ('jpg', 'jpeg', 'png')
+
+# encoder options for manipulated jpeg images, optimize and progressive make the
+# images a bit smaller but need extra passes (slower)
+JPEG_QUALITY = int(os.environ.get('JPEG_QUALITY', 85))
+JPEG_OPTIMIZE = os.environ.get('JPEG_OPTIMIZE', 'False') == 'True'
+JPEG_PROGRESSIVE = os.environ.get('JPEG_PROGRESSIVE', 'False') == 'True'
+
 # enables demo
 STORAGE_DIRECTORY = os.environ.get('STORAGE_DIR', os.path.join(BASE_DIR, 'storage'))
 ENABLE_DEMO = os.environ.get('ENABLE_DEMO', 'True') == 'True'
@@ -1,23 +1,65 @@
 import mimetypes
+import io
+import os
+import re
+import time
+import hashlib
+import threading
 import werkzeug
 from functools import wraps
 
 from flask import Flask, send_file, request, Response, render_template
 from flask_restful import Api, Resource, reqparse, fields, marshal_with
 from flask_cors import CORS
-from werkzeug.exceptions import Unauthorized
+from werkzeug.exceptions import Unauthorized, BadRequest, RequestEntityTooLarge, InternalServerError
+from PIL import Image as PILImage
 
+from image_service import image
 from image_service.storage import *
+from image_service.cache import LRUCache
 
 
 CONFIG_STORAGE_DIR = 'STORAGE_DIRECTORY'
+CONFIG_IMAGE_CACHE_SIZE = 'MANIPULATED_IMAGE_CACHE_SIZE'
+CONFIG_SOURCE_CACHE_SIZE = 'SOURCE_IMAGE_CACHE_SIZE'
+CONFIG_SOURCE_CACHE_MAX_FILE_SIZE = 'SOURCE_IMAGE_CACHE_MAX_FILE_SIZE'
+CONFIG_PRELOAD_SOURCE_IMAGES = 'PRELOAD_SOURCE_IMAGES'
+CONFIG_MAX_IMAGE_PIXELS = 'MAX_IMAGE_PIXELS'
+DEFAULT_MAX_IMAGE_PIXELS = 50000000
+CONFIG_JPEG_QUALITY = 'JPEG_QUALITY'
+CONFIG_JPEG_OPTIMIZE = 'JPEG_OPTIMIZE'
+CONFIG_JPEG_PROGRESSIVE = 'JPEG_PROGRESSIVE'
+CONFIG_ALLOWED_EXTENSIONS = 'ALLOWED_EXTENSIONS'
+DEFAULT_ALLOWED_EXTENSIONS = ('jpg', 'jpeg', 'png')
 
 app = Flask(__name__)
 app.config.from_pyfile('../config.py', silent=True)
 api = Api(app)
 cors = CORS(app, resources={r'/*': {'origins': '*'}})
 
+# Pillow's own decompression bomb limit (PIL.Image.MAX_IMAGE_PIXELS) is left alone, it applies
+# to every decoded image and not just uploads. newer Pillow versions raise instead of warning
+# for images with more than twice that many pixels.
+_DecompressionBombError = getattr(PILImage, 'DecompressionBombError', ())
+
+# encoder options for manipulated jpeg images
+image.SAVE_OPTIONS['JPEG'].update(
+    quality=app.config.get(CONFIG_JPEG_QUALITY, 85),
+    optimize=app.config.get(CONFIG_JPEG_OPTIMIZE, False),
+    progressive=app.config.get(CONFIG_JPEG_PROGRESSIVE, False))
+
+# <name>.<extension> of uploaded files, only allowed extensions match (case insensitive)
+_upload_filename_re = re.compile(r'^(.+)\.(%s)$' % '|'.join(
+    re.escape(extension) for extension in app.config.get(CONFIG_ALLOWED_EXTENSIONS,
+                                                         DEFAULT_ALLOWED_EXTENSIONS)), re.IGNORECASE)
+
 _storage = None
+_storage_lock = threading.Lock()
+_image_cache = None
+_image_cache_lock = threading.Lock()
+# bumped whenever an image changes, cached manipulated images of older generations are outdated
+_image_generations = {}
+_image_generations_lock = threading.Lock()
 
 
 @app.after_request
@@ -37,24 +79,83 @@ def storage():
     """returns access to the storage (save_image(), get() and exists())"""
     global _storage
     if not _storage:
-        _storage = FileSystemStorage(app.config[CONFIG_STORAGE_DIR])
+        with _storage_lock:
+            # check again, another thread may have created it in the meantime
+            if not _storage:
+                image_storage = FileSystemStorage(
+                    app.config[CONFIG_STORAGE_DIR],
+                    source_cache_size=app.config.get(CONFIG_SOURCE_CACHE_SIZE, 16),
+                    source_cache_max_file_size=app.config.get(CONFIG_SOURCE_CACHE_MAX_FILE_SIZE,
+                                                              SOURCE_CACHE_MAX_FILE_SIZE))
+                if app.config.get(CONFIG_PRELOAD_SOURCE_IMAGES, False):
+                    image_storage.preload()
+                _storage = image_storage
     return _storage
 
 
-def _serve_image(image_file, extension):
+def image_cache():
+    """returns the in memory cache for manipulated images (get(), set() and evict())"""
+    global _image_cache
+    if _image_cache is None:
+        with _image_cache_lock:
+            if _image_cache is None:
+                _image_cache = LRUCache(app.config.get(CONFIG_IMAGE_CACHE_SIZE, 128))
+    return _image_cache
+
+
+def _image_generation(name, extension):
+    return _image_generations.get((name, extension), 0)
+
+
+def _evict_cached_images(name, extension):
+    """outdates all cached manipulated versions of the image, including those a request
+       still in progress caches after the eviction (they belong to the previous generation)
+    """
+    with _image_generations_lock:
+        _image_generations[(name, extension)] = _image_generation(name, extension) + 1
+    image_cache().evict(lambda key: key[:2] == (name, extension))
+
+
+def _file_etag(image_file):
+    """returns (etag, last_modified) based on size and modification time of the file"""
+    stat = os.fstat(image_file.fileno())
+    return '%x-%x' % (int(stat.st_mtime * 1000000), stat.st_size), stat.st_mtime
+
+
+def _serve_image(image_file, extension, etag=None, last_modified=None):
     mime_type = mimetypes.types_map['.%s' % extension.lower()]
-    return send_file(image_file, mimetype=mime_type, add_etags=False)
+    # the cache timeout is taken from SEND_FILE_MAX_AGE_DEFAULT
+    response = send_file(image_file, mimetype=mime_type, add_etags=False)
+    if etag is not None:
+        response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response.make_conditional(request)
+
+
+def _check_uploaded_image(uploaded_file):
+    """rejects invalid or too large images before anything gets decoded or stored"""
+    try:
+        pixels = image.pixel_count(uploaded_file.stream)
+    except _DecompressionBombError:
+        raise RequestEntityTooLarge('The uploaded image has too many pixels.')
+    except IOError:
+        raise BadRequest('The uploaded file is not a valid image.')
+    if pixels > app.config.get(CONFIG_MAX_IMAGE_PIXELS, DEFAULT_MAX_IMAGE_PIXELS):
+        raise RequestEntityTooLarge('The uploaded image has too many pixels.')
 
 
 def _check_auth_token(origin, token):
-    if 'AUTH_TOKEN' in app.config and app.config['AUTH_TOKEN'] != '':
-        expected_origin, expected_token = app.config['AUTH_TOKEN']
+    auth_token = app.config.get('AUTH_TOKEN')
+    if auth_token:
+        expected_origin, expected_token = auth_token
         return (expected_origin == '*' or expected_origin == origin) and expected_token == token
 
 
 def _check_auth_basic(username, password):
-    if 'AUTH_BASIC' in app.config and app.config['AUTH_BASIC'] != '':
-        correct_user, correct_pass = app.config['AUTH_BASIC']
+    auth_basic = app.config.get('AUTH_BASIC')
+    if auth_basic:
+        correct_user, correct_pass = auth_basic
         return username == correct_user and password == correct_pass
 
 
@@ -92,12 +193,6 @@ def _upload_json_response(success, **kwargs):
     return res_dict, code
 
 
-def serve_image(project_name, name, extension, mode=None, size=None):
-    if project_name not in app.config['PROJECTS']:
-        raise NotFound()
-    return _serve_image(project_name, name, extension, mode, size)
-
-
 class UploadResponse:
     resource_fields = {
         'url': fields.String
@@ -120,10 +215,15 @@ class UploadAPI(Resource):
     def post(self):
         args = self.reqparse.parse_args()
         uploaded_file = args['file']
-        filename, extension = secure_filename(uploaded_file.filename).rsplit(
-            '.', 1)
-        filename = storage().safe_name(filename, extension)
-        storage().save(filename, extension, uploaded_file.read())
+        match = _upload_filename_re.match(secure_filename(uploaded_file.filename))
+        if match is None:
+            raise BadRequest('The file name or extension of the uploaded file is not allowed.')
+        # the same image uploaded as .JPG and .jpg gets the same url
+        filename, extension = match.group(1), match.group(2).lower()
+        _check_uploaded_image(uploaded_file)
+        image_storage = storage()
+        filename = image_storage.safe_name(filename, extension)
+        image_storage.save_file(filename, extension, uploaded_file.stream)
         url = api.url_for(ImageAPI, name=filename, extension=extension)
         return {'url': url}, 201
 
@@ -141,22 +241,42 @@ class ImageAPI(Resource):
 
     @requires_auth
     def put(self, name, extension):
+        if _upload_filename_re.match('%s.%s' % (name, extension)) is None:
+            raise BadRequest('The extension of the image is not allowed.')
         args = self.reqparse.parse_args()
         uploaded_file = args['file']
-        created = not storage().exists(name, extension)
-        storage().save(name, extension, uploaded_file.read())
+        _check_uploaded_image(uploaded_file)
+        image_storage = storage()
+        created = not image_storage.exists(name, extension)
+        image_storage.save_file(name, extension, uploaded_file.stream)
+        _evict_cached_images(name, extension)
         return Response('', 201 if created else 200)
 
     @requires_auth
-    def delete(self, project, name, extension):
-        if storage().exists(project, name, extension):
-            storage().delete(project, name, extension)
+    def delete(self, name, extension):
+        image_storage = storage()
+        if image_storage.exists(name, extension):
+            image_storage.delete(name, extension)
+            _evict_cached_images(name, extension)
             return Response('', 200)
         raise NotFound()
 
     def get(self, name, extension):
-        image = storage().get(name, extension)
-        return _serve_image(image, extension)
+        image_file = storage().get(name, extension)
+        etag, last_modified = _file_etag(image_file)
+        return _serve_image(image_file, extension, etag, last_modified)
+
+
+class RegenerateImageAPI(Resource):
+    """
+    API that supports POST to recreate all manipulated versions of an image.
+    """
+    decorators = [requires_auth]
+
+    def post(self, name, extension):
+        storage().regenerate(name, extension)
+        _evict_cached_images(name, extension)
+        return Response('', 200)
 
 
 class ManipulatedImageAPI(Resource):
@@ -166,12 +286,41 @@ class ManipulatedImageAPI(Resource):
 
     def get(self, name, mode, width, height, extension):
         try:
-            image = storage().get(name, extension, mode, (int(width), int(height)))
+            cache_key = (name, extension, mode, (int(width), int(height)))
         except ValueError:
             raise NotFound()
-        return _serve_image(image, extension)
+        # read the generation before the image, a change in between outdates the cached image
+        generation = _image_generation(name, extension)
+        cached_image = image_cache().get(cache_key)
+        if cached_image is None or cached_image[0] != generation:
+            try:
+                image_file = storage().get(*cache_key)
+            except ValueError:
+                raise NotFound()
+            except _DecompressionBombError:
+                raise InternalServerError('The original image has too many pixels to be manipulated.')
+            if isinstance(image_file, io.BytesIO):
+                # freshly manipulated in memory (not written yet), so there are no file based validators
+                binary_image_data = image_file.getvalue()
+                etag, last_modified = hashlib.md5(binary_image_data).hexdigest(), time.time()
+            else:
+                etag, last_modified = _file_etag(image_file)
+                if image_cache().maxsize <= 0:
+                    # nothing gets cached, let send_file() stream the file
+                    return _serve_image(image_file, extension, etag, last_modified)
+                with image_file:
+                    binary_image_data = image_file.read()
+            cached_image = (generation, binary_image_data, etag, last_modified)
+            image_cache().set(cache_key, cached_image)
+        _, binary_image_data, etag, last_modified = cached_image
+        return _serve_image(io.BytesIO(binary_image_data), extension, etag, last_modified)
 
 
 api.add_resource(UploadAPI, '/images/')
 api.add_resource(ImageAPI, '/images/<name>.<extension>')
+api.add_resource(RegenerateImageAPI, '/images/<name>.<extension>/regenerate')
 api.add_resource(ManipulatedImageAPI, '/images/<name>@<mode>-<width>x<height>.<extension>')
+
+if app.config.get(CONFIG_PRELOAD_SOURCE_IMAGES, False):
+    # preload when the app is loaded, not while the first requests wait for it
+    storage()
@@ -0,0 +1,56 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """a small thread safe least recently used cache.
+
+       a maxsize of 0 disables the cache (nothing gets stored).
+    """
+
+    def __init__(self, maxsize=128):
+        self._maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def maxsize(self):
+        return self._maxsize
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items[key]
+            except KeyError:
+                return default
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self._maxsize <= 0:
+            return
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self._maxsize:
+                self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._items.pop(key, default)
+
+    def evict(self, predicate):
+        """removes all items whose key matches the given predicate"""
+        with self._lock:
+            for key in [key for key in self._items if predicate(key)]:
+                del self._items[key]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
@@ -1,10 +1,23 @@
+import io
 import os
-import tempfile
 import mimetypes
 
 from PIL import Image, ImageOps
 
 
+# ANTIALIAS is just a deprecated alias of LANCZOS
+RESAMPLE_FILTER = Image.LANCZOS
+# large images are first reduced with a cheap box filter to at most REDUCING_GAP
+# times the target size, only the rest is resampled with RESAMPLE_FILTER
+REDUCING_GAP = 3
+
+# encoder options by pil format. optimize and progressive need extra passes over the
+# image, so they're off by default for the lowest latency (see JPEG_* in config.py)
+SAVE_OPTIONS = {
+    'JPEG': {'quality': 85, 'optimize': False, 'progressive': False},
+}
+
+
 # for now we only support the two formats ;)
 def pil_format_from_mime_type(mime_type):
     if mime_type == 'image/jpeg':
@@ -19,22 +32,82 @@ def pil_format_from_file_extension(file_extension):
     return pil_format_from_mime_type(mime_type)
 
 
+def pixel_count(image):
+    """returns width * height of the image, only the image header is parsed"""
+    position = image.tell()
+    try:
+        width, height = Image.open(image).size
+    finally:
+        image.seek(position)
+    return width * height
+
+
 def binary_image(pil_image, format):
-    binary = tempfile.TemporaryFile()
-    pil_image.save(binary, format)
+    binary = io.BytesIO()
+    pil_image.save(binary, format, **SAVE_OPTIONS.get(format, {}))
     binary.seek(0)
     return binary
 
 
-def fit_image(image, size):
+def fit_size(image_size, max_size):
+    """returns the largest size with the aspect ratio of image_size fitting into max_size.
+
+       images are never scaled up, pure integer math to not truncate to a width or height of 0.
+    """
+    width, height = image_size
+    max_width, max_height = max_size
+    if width <= max_width and height <= max_height:
+        return width, height
+    if width * max_height <= height * max_width:
+        return max(width * max_height // height, 1), max_height
+    return max_width, max(height * max_width // width, 1)
+
+
+def cover_size(image_size, min_size):
+    """returns the smallest size with the aspect ratio of image_size covering min_size"""
+    width, height = image_size
+    min_width, min_height = min_size
+    if width * min_height >= height * min_width:
+        return -(-width * min_height // height), min_height
+    return min_width, -(-height * min_width // width)
+
+
+def reduce_image(pil_image, size):
+    """downscales the image by an integer factor while keeping it REDUCING_GAP times larger than size"""
+    width, height = pil_image.size
+    factor = min(width // (size[0] * REDUCING_GAP), height // (size[1] * REDUCING_GAP))
+    if factor < 2:
+        return pil_image
+    return pil_image.resize((-(-width // factor), -(-height // factor)), Image.BOX)
+
+
+def _pil_format(image, pil_format):
+    if pil_format is None:
+        pil_format = pil_format_from_file_extension(os.path.splitext(image.name)[1])
+    return pil_format
+
+
+def fit_image(image, size, pil_format=None):
     pil_image = Image.open(image)
-    pil_image.thumbnail(size, Image.ANTIALIAS)
-    pil_format = pil_format_from_file_extension(os.path.splitext(image.name)[1])
-    return binary_image(pil_image, pil_format)
+    fitted_size = fit_size(pil_image.size, size)
+    if fitted_size != pil_image.size:
+        # let the jpeg decoder downscale while decoding, as thumbnail() does
+        pil_image.draft(None, fitted_size)
+        pil_image = reduce_image(pil_image, fitted_size).resize(fitted_size, RESAMPLE_FILTER)
+    return binary_image(pil_image, _pil_format(image, pil_format))
 
 
-def crop_image(image, size):
+def crop_image(image, size, pil_format=None):
     pil_image = Image.open(image)
-    cropped_pil_image = ImageOps.fit(pil_image, size, Image.ANTIALIAS, 0.0, (0.5, 0.5))
-    pil_format = pil_format_from_file_extension(os.path.splitext(image.name)[1])
-    return binary_image(cropped_pil_image, pil_format)
+    # the jpeg decoder may downscale as long as the crop is still covered
+    pil_image.draft(None, cover_size(pil_image.size, size))
+    pil_image = reduce_image(pil_image, cover_size(pil_image.size, size))
+    cropped_pil_image = ImageOps.fit(pil_image, size, RESAMPLE_FILTER, 0.0, (0.5, 0.5))
+    return binary_image(cropped_pil_image, _pil_format(image, pil_format))
+
+
+# manipulation functions by mode (as used in the urls)
+MANIPULATIONS = {
+    'crop': crop_image,
+    'fit': fit_image,
+}
@@ -1,63 +1,149 @@
+import io
 import os
+import re
 import os.path as op
 import shutil
+import logging
+import threading
+from concurrent import futures
+from contextlib import contextmanager
 
 from flask import safe_join
 from werkzeug.utils import secure_filename
 from werkzeug.exceptions import NotFound
 
 from image_service import image
+from image_service.cache import LRUCache
+
+
+COPY_BUFFER_SIZE = 64 * 1024
+SOURCE_CACHE_MAX_FILE_SIZE = 8 * 1024 * 1024
+IMAGE_LOCK_STRIPES = 64
+# directory (within the image directory) for files being written, image names never start with a dot
+TEMP_DIRECTORY = '.tmp'
+
+# <mode>-<width>x<height>.<extension> of manipulated images
+MANIPULATED_FILENAME_RE = re.compile(r'^([a-z]+)-(\d+)x(\d+)\.[^.]+$')
+
+log = logging.getLogger(__name__)
 
 
 class FileSystemStorage(object):
-    def __init__(self, image_dir):
+    def __init__(self, image_dir, writer_threads=2, source_cache_size=16,
+                 source_cache_max_file_size=SOURCE_CACHE_MAX_FILE_SIZE):
         self._image_dir = image_dir
-        if not op.isdir(self._image_dir):
-            os.makedirs(self._image_dir)
+        # not within the manipulated directories, so removing them never races a write
+        self._temp_dir = op.join(image_dir, TEMP_DIRECTORY)
+        if not op.isdir(self._temp_dir):
+            os.makedirs(self._temp_dir)
+        # binary data of recently manipulated originals, see _read_original()
+        # larger originals are not cached, which bounds the memory to size * max_file_size
+        self._source_cache = LRUCache(source_cache_size)
+        self._source_cache_max_file_size = source_cache_max_file_size
+        # manipulated images are written in the background (write-behind)
+        self._writer = futures.ThreadPoolExecutor(max_workers=writer_threads)
+        self._pending_writes = set()
+        self._pending_writes_lock = threading.Lock()
+        # replacing an original (or writing one of its manipulated versions) and
+        # checking it's still the same is done while holding the image's lock
+        self._image_locks = [threading.Lock() for _ in range(IMAGE_LOCK_STRIPES)]
 
     def _check_mode_size(self, mode=None, size=None):
         if (mode or size) and (not mode or not size):
             raise ValueError('mode and size bust be given both or neither')
-        if mode and not mode in ('crop', 'fit'):
+        if mode and mode not in image.MANIPULATIONS:
             raise ValueError('only fit or crop allowed for mode')
+        if size and (size[0] < 1 or size[1] < 1):
+            raise ValueError('width and height must be at least 1')
 
     def exists(self, name, extension, mode=None, size=None):
         return op.isfile(self._path_to_image(name, extension, mode, size))
 
     def save(self, name, extension, binary_image_data, mode=None, size=None):
-        self._check_mode_size(mode, size)
-        if self.exists(name, extension, mode, size):
-            self.delete(name, extension, mode, size)
-        with open(self._path_to_image(name, extension, mode, size), 'wb') as f:
-            f.write(binary_image_data)
+        with self._open_for_writing(name, extension, mode, size) as image_file:
+            image_file.write(binary_image_data)
+
+    def save_file(self, name, extension, source_file, mode=None, size=None):
+        """like save() but copies the image from a file like object in chunks"""
+        with self._open_for_writing(name, extension, mode, size) as image_file:
+            shutil.copyfileobj(source_file, image_file, COPY_BUFFER_SIZE)
 
     def get(self, name, extension, mode=None, size=None):
+        image_file = self.try_get(name, extension, mode, size)
+        if image_file is None:
+            raise NotFound()
+        return image_file
+
+    def try_get(self, name, extension, mode=None, size=None):
+        """like get() but returns None instead of raising NotFound"""
         self._check_mode_size(mode, size)
         image_path = self._path_to_image(name, extension, mode, size)
-        if mode and not op.isfile(image_path):
-            original_image = self.get(name, extension)
-            if mode == 'crop':
-                manipulated_image = image.crop_image(original_image, size)
-            elif mode == 'fit':
-                manipulated_image = image.fit_image(original_image, size)
-            self.save(name, extension, manipulated_image.read(), mode, size)
-
-        if op.isfile(image_path):
+        try:
             return open(image_path, 'rb')
-        else:
+        except FileNotFoundError:
+            if not mode:
+                return None
+        source_version, original_image_data = self._read_original(name, extension)
+        if original_image_data is None:
+            return None
+        binary_image_data = self._manipulate(original_image_data, extension, mode, size)
+        # serve the manipulated image from memory, no need to wait until it's written
+        self._save_behind(name, extension, binary_image_data, mode, size, source_version)
+        return io.BytesIO(binary_image_data)
+
+    def regenerate(self, name, extension):
+        """recreates all existing manipulated versions of the image (e.g. after changing
+           the encoder options) and returns their number once they are written.
+        """
+        source_version, original_image_data = self._read_original(name, extension)
+        if original_image_data is None:
             raise NotFound()
+        try:
+            filenames = os.listdir(self._manipulated_directory(name, extension))
+        except FileNotFoundError:
+            return 0
+        regenerated = 0
+        for filename in filenames:
+            match = MANIPULATED_FILENAME_RE.match(filename)
+            if match is None or match.group(1) not in image.MANIPULATIONS:
+                continue
+            mode, size = match.group(1), (int(match.group(2)), int(match.group(3)))
+            binary_image_data = self._manipulate(original_image_data, extension, mode, size)
+            self._save_manipulated(name, extension, binary_image_data, mode, size, source_version)
+            regenerated += 1
+        return regenerated
+
+    def preload(self):
+        """reads the most recently changed originals into memory (as many as the source cache holds)"""
+        originals = []
+        for entry in os.scandir(self._image_dir):
+            if entry.is_file() and '.' in entry.name:
+                stat = entry.stat()
+                if stat.st_size <= self._source_cache_max_file_size:
+                    originals.append((stat.st_mtime, entry.name))
+        originals.sort(reverse=True)
+        # oldest first, so the most recently changed originals are used most recently
+        for _, filename in reversed(originals[:self._source_cache.maxsize]):
+            name, extension = filename.rsplit('.', 1)
+            self._read_original(name, extension)
+
+    def flush(self):
+        """blocks until all manipulated images are written"""
+        with self._pending_writes_lock:
+            pending_writes = list(self._pending_writes)
+        futures.wait(pending_writes)
 
     def delete(self, name, extension, mode=None, size=None):
         path_to_image = self._path_to_image(name, extension, mode, size)
-        try:
-            os.remove(path_to_image)
-        except OSError:
-            raise NotFound()
-        # only delete all files when no mode and size are given...
-        if mode is None and size is None:
-            manipulated_dir = self._manipulated_directory(name, extension)
-            if op.isdir(manipulated_dir):
-                shutil.rmtree(self._manipulated_directory(name, extension))
+        with self._image_lock(name, extension):
+            try:
+                os.remove(path_to_image)
+            except OSError:
+                raise NotFound()
+            # only delete all files when no mode and size are given...
+            if mode is None and size is None:
+                self._source_cache.pop((name, extension))
+                self._delete_manipulated(name, extension)
 
     def safe_name(self, name, extension):
         counter = 1
@@ -70,6 +156,101 @@ class FileSystemStorage(object):
     def _manipulated_directory(self, name, extension):
         return safe_join(self._image_dir, '_%s.%s' % (name, extension))
 
+    def _image_lock(self, name, extension):
+        return self._image_locks[hash((name, extension)) % len(self._image_locks)]
+
+    def _original_version(self, name, extension):
+        """returns (inode, mtime, size) of the original image (None if it doesn't exist)"""
+        try:
+            return _file_version(os.stat(self._path_to_image(name, extension)))
+        except FileNotFoundError:
+            return None
+
+    def _read_original(self, name, extension):
+        """returns (version, binary data) of the original image ((None, None) if it doesn't exist).
+
+           the data is cached as long as the file stays the same, so generating several
+           sizes of the same image only costs a stat() instead of reading it again.
+        """
+        source_version = self._original_version(name, extension)
+        if source_version is None:
+            return None, None
+        cached = self._source_cache.get((name, extension))
+        if cached is not None and cached[0] == source_version:
+            return cached
+        try:
+            image_file = open(self._path_to_image(name, extension), 'rb')
+        except FileNotFoundError:
+            return None, None
+        with image_file:
+            source_version = _file_version(os.fstat(image_file.fileno()))
+            original_image_data = image_file.read()
+        if len(original_image_data) <= self._source_cache_max_file_size:
+            self._source_cache.set((name, extension), (source_version, original_image_data))
+        return source_version, original_image_data
+
+    def _manipulate(self, original_image_data, extension, mode, size):
+        manipulated_image = image.MANIPULATIONS[mode](
+            io.BytesIO(original_image_data), size,
+            image.pil_format_from_file_extension('.' + extension))
+        # the buffer is not used afterwards, so getvalue() can share its bytes instead of copying
+        return manipulated_image.getvalue()
+
+    def _save_manipulated(self, name, extension, binary_image_data, mode, size, source_version):
+        """saves a manipulated image unless its original changed since source_version was read"""
+        with self._open_for_writing(name, extension, mode, size, source_version) as image_file:
+            image_file.write(binary_image_data)
+
+    def _save_behind(self, name, extension, binary_image_data, mode, size, source_version):
+        future = self._writer.submit(self._save_manipulated, name, extension, binary_image_data,
+                                     mode, size, source_version)
+        with self._pending_writes_lock:
+            self._pending_writes.add(future)
+        future.add_done_callback(self._write_done)
+
+    def _write_done(self, future):
+        with self._pending_writes_lock:
+            self._pending_writes.discard(future)
+        if future.exception() is not None:
+            log.error('writing a manipulated image failed', exc_info=future.exception())
+
+    @contextmanager
+    def _open_for_writing(self, name, extension, mode=None, size=None, source_version=None):
+        """yields a temporary file which replaces the image once it's completely written,
+           so readers never see partially written images.
+
+           with a source_version the written file is dropped if the original image was
+           replaced or deleted since that version was read.
+        """
+        self._check_mode_size(mode, size)
+        image_path = self._path_to_image(name, extension, mode, size)
+        temp_path = op.join(self._temp_dir, '%d-%d.tmp' % (os.getpid(), threading.get_ident()))
+        image_file = open(temp_path, 'wb')
+        try:
+            with image_file:
+                yield image_file
+        except BaseException:
+            _remove(temp_path)
+            raise
+        with self._image_lock(name, extension):
+            if source_version is not None and self._original_version(name, extension) != source_version:
+                _remove(temp_path)
+                log.info('dropped outdated manipulated image %s', image_path)
+                return
+            if mode:
+                # created under the lock, so a dropped write never leaves an empty directory behind
+                os.makedirs(op.dirname(image_path), exist_ok=True)
+            os.replace(temp_path, image_path)
+            if mode is None:
+                # manipulated versions of the replaced original are outdated
+                self._delete_manipulated(name, extension)
+
+    def _delete_manipulated(self, name, extension):
+        try:
+            shutil.rmtree(self._manipulated_directory(name, extension))
+        except FileNotFoundError:
+            pass
+
     def _path_to_image(self, name, extension, mode=None, size=None):
         if mode:
             filename = secure_filename('%s-%dx%d.%s' % (mode, size[0], size[1], extension))
@@ -77,6 +258,15 @@ class FileSystemStorage(object):
         else:
             filename = secure_filename(name + '.' + extension)
             directory = self._image_dir
-        if not op.isdir(directory):
-            os.makedirs(directory)
         return safe_join(directory, filename)
+
+
+def _file_version(stat):
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
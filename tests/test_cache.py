@@ -0,0 +1,46 @@
+import unittest
+
+from image_service.cache import LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_get_and_set(self):
+        cache = LRUCache(2)
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', b'a')
+        self.assertEqual(b'a', cache.get('a'))
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set('a', b'a')
+        cache.set('b', b'b')
+        cache.get('a')
+        cache.set('c', b'c')
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIn('c', cache)
+        self.assertEqual(2, len(cache))
+
+    def test_maxsize(self):
+        self.assertEqual(2, LRUCache(2).maxsize)
+
+    def test_disabled(self):
+        cache = LRUCache(0)
+        cache.set('a', b'a')
+        self.assertIsNone(cache.get('a'))
+
+    def test_pop(self):
+        cache = LRUCache(2)
+        cache.set('a', b'a')
+        self.assertEqual(b'a', cache.pop('a'))
+        self.assertIsNone(cache.pop('a'))
+        self.assertNotIn('a', cache)
+
+    def test_evict(self):
+        cache = LRUCache(4)
+        cache.set(('image', 'png', 'crop'), b'a')
+        cache.set(('image', 'png', 'fit'), b'b')
+        cache.set(('other', 'png', 'fit'), b'c')
+        cache.evict(lambda key: key[:2] == ('image', 'png'))
+        self.assertEqual(1, len(cache))
+        self.assertIn(('other', 'png', 'fit'), cache)
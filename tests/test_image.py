@@ -1,5 +1,6 @@
 import unittest
 import os
+from io import BytesIO
 
 from PIL import Image as PILImage
 
@@ -20,6 +21,18 @@ class TestImage(unittest.TestCase):
             pil_image = PILImage.open(image.fit_image(png_file, [200, 200]))
             self.assertEqual((200, 150), pil_image.size)
 
+    def test_fit_size(self):
+        for image_size, max_size in (((640, 480), (200, 200)),
+                                     ((480, 640), (200, 200)),
+                                     ((640, 480), (1000, 1000)),
+                                     ((640, 480), (640, 100)),
+                                     ((1920, 1080), (333, 777)),
+                                     ((1000, 3), (100, 100)),
+                                     ((3, 1000), (100, 100))):
+            pil_image = PILImage.new('RGB', image_size)
+            pil_image.thumbnail(max_size)
+            self.assertEqual(pil_image.size, image.fit_size(image_size, max_size))
+
     def test_crop_image(self):
         image_path = 'png_image.png'
         with open(self._test_image_path('%s' % image_path), 'rb') as png_file:
@@ -28,3 +41,40 @@ class TestImage(unittest.TestCase):
             png_file.seek(0)
             pil_image = PILImage.open(image.crop_image(png_file, [200, 200]))
             self.assertEqual((200, 200), pil_image.size)
+
+    def test_cover_size(self):
+        self.assertEqual((267, 200), image.cover_size((640, 480), (200, 200)))
+        self.assertEqual((200, 267), image.cover_size((480, 640), (200, 200)))
+        self.assertEqual((640, 480), image.cover_size((640, 480), (640, 100)))
+        self.assertEqual((1600, 1200), image.cover_size((640, 480), (1600, 1200)))
+
+    def test_crop_jpg_image(self):
+        with open(self._test_image_path('jpg_image.jpg'), 'rb') as jpg_file:
+            pil_image = PILImage.open(image.crop_image(jpg_file, [150, 300]))
+            self.assertEqual((150, 300), pil_image.size)
+
+    def test_reduce_image(self):
+        pil_image = PILImage.new('RGB', (3000, 2000))
+        self.assertEqual((500, 334), image.reduce_image(pil_image, (100, 100)).size)
+        self.assertIs(pil_image, image.reduce_image(pil_image, (1000, 1000)))
+
+    def test_fit_large_image(self):
+        png_file = BytesIO()
+        PILImage.new('RGB', (3000, 2000)).save(png_file, 'PNG')
+        png_file.seek(0)
+        pil_image = PILImage.open(image.fit_image(png_file, [100, 100], pil_format='PNG'))
+        self.assertEqual((100, 66), pil_image.size)
+
+    def test_jpeg_save_options(self):
+        with open(self._test_image_path('jpg_image.jpg'), 'rb') as jpg_file:
+            pil_image = PILImage.open(jpg_file)
+            pil_image.load()
+        low_quality_options = dict(image.SAVE_OPTIONS['JPEG'], quality=10)
+        default_options = image.SAVE_OPTIONS['JPEG']
+        try:
+            image.SAVE_OPTIONS['JPEG'] = low_quality_options
+            low_quality_image = image.binary_image(pil_image, 'JPEG')
+        finally:
+            image.SAVE_OPTIONS['JPEG'] = default_options
+        default_image = image.binary_image(pil_image, 'JPEG')
+        self.assertLess(len(low_quality_image.getvalue()), len(default_image.getvalue()))
@@ -11,6 +11,7 @@ import base64
 from PIL import Image as PILImage
 
 import image_service
+from image_service import image
 
 
 class TestImageService(unittest.TestCase):
@@ -27,8 +28,12 @@ class TestImageService(unittest.TestCase):
         image_service.app.config['AUTH_BASIC'] = (self.username, self.password)
         self.app = image_service.app.test_client()
         image_service._storage = None
+        image_service._image_cache = None
+        image_service._image_generations.clear()
 
     def tearDown(self):
+        if image_service._storage is not None:
+            image_service._storage.flush()
         try:
             shutil.rmtree(self.storage_directory)
         except OSError:
@@ -63,11 +68,20 @@ class TestImageService(unittest.TestCase):
                             },
                             data={'file': (binary_image, image_name)})
 
-    def _get_image(self, image_name, image_extension, mode=None, size=None):
+    def _delete_image(self, image_name, origin=None, auth_token=None):
+        origin = self.origin if not origin else origin
+        auth_token = self.auth_token if not auth_token else auth_token
+        return self.app.delete('/images/%s' % image_name,
+                               headers={
+                                   'Authorization': 'Token ' + auth_token,
+                                   'Origin': origin
+                               })
+
+    def _get_image(self, image_name, image_extension, mode=None, size=None, headers=None):
         resource_url = '/images/%s.%s' % (image_name, image_extension)
         if mode and size:
             resource_url = '/images/%s@%s-%dx%d.%s' % (image_name, mode, size[0], size[1], image_extension)
-        return self.app.get(resource_url)
+        return self.app.get(resource_url, headers=headers)
 
 
     def test_create_storage(self):
@@ -144,6 +158,51 @@ class TestImageService(unittest.TestCase):
             self.assertIsNotNone(image)
             self.assertEqual('%s.%s' % (image_name, image_extension), os.path.basename(image.name))
 
+    def test_post_uppercase_extension(self):
+        with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+            response = self._post_image(png_image, 'test_image.PNG')
+        self.assertEqual(201, response.status_code)
+        self.assertEqual('/images/test_image.png', json.loads(response.data.decode())['url'])
+        self.assertTrue(image_service.storage().exists('test_image', 'png'))
+        with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+            response = self._post_image(png_image, 'test_image.png')
+        self.assertEqual('/images/test_image-1.png', json.loads(response.data.decode())['url'])
+
+    def test_post_invalid_filename(self):
+        for filename in ('test_image.gif', 'test_image', '.png'):
+            with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+                response = self._post_image(png_image, filename)
+            self.assertEqual(400, response.status_code)
+
+    def test_post_invalid_image(self):
+        response = self._post_image(BytesIO(b'no image'), 'test_image.png')
+        self.assertEqual(400, response.status_code)
+
+    def test_post_too_large_image(self):
+        max_image_pixels = image_service.app.config.get('MAX_IMAGE_PIXELS',
+                                                        image_service.DEFAULT_MAX_IMAGE_PIXELS)
+        image_service.app.config['MAX_IMAGE_PIXELS'] = 640 * 480 - 1
+        try:
+            with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+                response = self._post_image(png_image, 'test_image.png')
+        finally:
+            image_service.app.config['MAX_IMAGE_PIXELS'] = max_image_pixels
+        self.assertEqual(413, response.status_code)
+
+    def test_post_decompression_bomb(self):
+        max_image_pixels = image_service.app.config.get('MAX_IMAGE_PIXELS',
+                                                        image_service.DEFAULT_MAX_IMAGE_PIXELS)
+        pil_max_image_pixels = PILImage.MAX_IMAGE_PIXELS
+        # far more pixels than Pillow allows (which raises instead of warning since Pillow 5)
+        image_service.app.config['MAX_IMAGE_PIXELS'] = PILImage.MAX_IMAGE_PIXELS = 100
+        try:
+            with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+                response = self._post_image(png_image, 'test_image.png')
+        finally:
+            image_service.app.config['MAX_IMAGE_PIXELS'] = max_image_pixels
+            PILImage.MAX_IMAGE_PIXELS = pil_max_image_pixels
+        self.assertEqual(413, response.status_code)
+
     def test_create_identical_name_image(self):
         image_name = 'test_image'
         image_extension = 'png'
@@ -164,6 +223,14 @@ class TestImageService(unittest.TestCase):
         self.assertEqual(201, response.status_code)
         self.assertEqual(b'', response.data)
 
+    def test_put_invalid_extension(self):
+        with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+            response = self._put_image(png_image, 'test_image.foo')
+        self.assertEqual(400, response.status_code)
+        self.assertFalse(image_service.storage().exists('test_image', 'foo'))
+        response = self._get_image('test_image', 'foo')
+        self.assertEqual(404, response.status_code)
+
     def test_update_image(self):
         image_name = 'test_image'
         image_extension = 'png'
@@ -173,6 +240,45 @@ class TestImageService(unittest.TestCase):
             response = self._put_image(png_image, '%s.%s' % (image_name, image_extension))
             self.assertEqual(200, response.status_code)
 
+    def test_delete_image(self):
+        image_name = 'test_image'
+        image_extension = 'png'
+        with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+            self._put_image(png_image, '%s.%s' % (image_name, image_extension))
+        response = self._delete_image('%s.%s' % (image_name, image_extension))
+        self.assertEqual(200, response.status_code)
+        self.assertFalse(image_service.storage().exists(image_name, image_extension))
+        response = self._delete_image('%s.%s' % (image_name, image_extension))
+        self.assertEqual(404, response.status_code)
+
+    def test_regenerate_image(self):
+        image_name = 'test_image'
+        image_extension = 'jpg'
+        headers = {'Authorization': 'Token ' + self.auth_token, 'Origin': self.origin}
+        with open(self._test_image_path('jpg_image.jpg'), 'rb') as jpg_image:
+            self._put_image(jpg_image, '%s.%s' % (image_name, image_extension))
+        outdated_data = self._get_image(image_name, image_extension, mode='fit', size=(200, 200)).data
+        image_service.storage().flush()
+        jpeg_options = dict(image.SAVE_OPTIONS['JPEG'])
+        image.SAVE_OPTIONS['JPEG']['quality'] = 10
+        try:
+            response = self.app.post('/images/%s.%s/regenerate' % (image_name, image_extension),
+                                     headers=headers)
+        finally:
+            image.SAVE_OPTIONS['JPEG'].update(jpeg_options)
+        self.assertEqual(200, response.status_code)
+        # the regenerated image is served right away, not the outdated one
+        response = self._get_image(image_name, image_extension, mode='fit', size=(200, 200))
+        manipulated_path = os.path.join(self.storage_directory, '_%s.%s' % (image_name, image_extension),
+                                        'fit-200x200.%s' % image_extension)
+        with open(manipulated_path, 'rb') as image_file:
+            self.assertEqual(image_file.read(), response.data)
+        self.assertNotEqual(outdated_data, response.data)
+        response = self.app.post('/images/not_existing.png/regenerate', headers=headers)
+        self.assertEqual(404, response.status_code)
+        response = self.app.post('/images/%s.%s/regenerate' % (image_name, image_extension))
+        self.assertEqual(401, response.status_code)
+
     def test_get_image(self):
         image_name = 'test_image'
         image_extension = 'png'
@@ -185,6 +291,44 @@ class TestImageService(unittest.TestCase):
         with open(self._test_image_path('png_image.png'), 'rb') as png_image:
             self.assertEqual(response.data, png_image.read())
 
+    def test_get_image_not_modified(self):
+        image_name = 'test_image'
+        image_extension = 'png'
+        with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+            self._put_image(png_image, '%s.%s' % (image_name, image_extension))
+        for mode, size in ((None, None), ('crop', (200, 200))):
+            response = self._get_image(image_name, image_extension, mode, size)
+            self.assertEqual(200, response.status_code)
+            etag = response.headers['ETag']
+            self.assertIsNotNone(response.headers.get('Last-Modified'))
+            self.assertIn('max-age', response.headers['Cache-Control'])
+            response = self._get_image(image_name, image_extension, mode, size,
+                                       headers={'If-None-Match': etag})
+            self.assertEqual(304, response.status_code)
+            self.assertEqual(b'', response.data)
+
+    def test_get_written_manipulated_image_without_cache(self):
+        image_name = 'test_image'
+        image_extension = 'png'
+        cache_size = image_service.app.config.get('MANIPULATED_IMAGE_CACHE_SIZE', 128)
+        image_service.app.config['MANIPULATED_IMAGE_CACHE_SIZE'] = 0
+        try:
+            with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+                self._put_image(png_image, '%s.%s' % (image_name, image_extension))
+            self._get_image(image_name, image_extension, 'crop', (200, 200))
+            image_service.storage().flush()
+            response = self._get_image(image_name, image_extension, 'crop', (200, 200))
+        finally:
+            image_service.app.config['MANIPULATED_IMAGE_CACHE_SIZE'] = cache_size
+        # validators of the written file, as for originals
+        with image_service.storage().get(image_name, image_extension, 'crop', (200, 200)) as image_file:
+            etag, last_modified = image_service._file_etag(image_file)
+            self.assertEqual(image_file.read(), response.data)
+        self.assertEqual('"%s"' % etag, response.headers['ETag'])
+        response = self._get_image(image_name, image_extension, 'crop', (200, 200),
+                                   headers={'If-Modified-Since': response.headers['Last-Modified']})
+        self.assertEqual(304, response.status_code)
+
     def test_get_manipulated_image(self):
         image_name = 'test_image'
         image_extension = 'png'
@@ -197,6 +341,57 @@ class TestImageService(unittest.TestCase):
         pil_image = PILImage.open(BytesIO(response.data))
         self.assertEqual((200, 200), pil_image.size)
 
+    def test_manipulated_image_cache(self):
+        image_name = 'test_image'
+        image_extension = 'png'
+        cache_key = (image_name, image_extension, 'crop', (200, 200))
+        with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+            self._put_image(png_image, '%s.%s' % (image_name, image_extension))
+        response = self._get_image(image_name, image_extension, mode='crop', size=(200, 200))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(response.data, image_service.image_cache().get(cache_key)[1])
+        with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+            self._put_image(png_image, '%s.%s' % (image_name, image_extension))
+        self.assertNotIn(cache_key, image_service.image_cache())
+
+    def test_manipulated_image_cache_outdated_during_get(self):
+        image_name = 'test_image'
+        image_extension = 'png'
+        with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+            self._put_image(png_image, '%s.%s' % (image_name, image_extension))
+        image_storage = image_service.storage()
+        get = image_storage.get
+
+        def get_while_replaced(*args):
+            image_file = get(*args)
+            # what a concurrent PUT does after the outdated image was read
+            with open(self._test_image_path('jpg_image.jpg'), 'rb') as jpg_image:
+                image_storage.save(image_name, image_extension, jpg_image.read())
+            image_service._evict_cached_images(image_name, image_extension)
+            return image_file
+        image_storage.get = get_while_replaced
+        response = self._get_image(image_name, image_extension, mode='fit', size=(1000, 1000))
+        del image_storage.get
+        self.assertEqual((640, 480), PILImage.open(BytesIO(response.data)).size)
+        response = self._get_image(image_name, image_extension, mode='fit', size=(1000, 1000))
+        self.assertEqual((1000, 750), PILImage.open(BytesIO(response.data)).size)
+
+    @unittest.skipUnless(hasattr(PILImage, 'DecompressionBombError'), 'Pillow only warns')
+    def test_get_manipulated_decompression_bomb(self):
+        image_name = 'test_image'
+        image_extension = 'png'
+        with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+            self._put_image(png_image, '%s.%s' % (image_name, image_extension))
+        # e.g. an original stored before Pillow's limit was lowered
+        pil_max_image_pixels = PILImage.MAX_IMAGE_PIXELS
+        PILImage.MAX_IMAGE_PIXELS = 100
+        try:
+            response = self._get_image(image_name, image_extension, mode='fit', size=(200, 200))
+        finally:
+            PILImage.MAX_IMAGE_PIXELS = pil_max_image_pixels
+        self.assertEqual(500, response.status_code)
+        self.assertIn(b'too many pixels', response.data)
+
     def test_get_manipulated_invalid_mode(self):
         image_name = 'test_image'
         image_extension = 'png'
@@ -1,6 +1,9 @@
 import unittest
+import os
 import os.path as op
 import shutil
+import logging
+import threading
 
 from PIL import Image as PILImage
 from werkzeug.exceptions import NotFound
@@ -19,6 +22,7 @@ class TestFileSystemStorage(unittest.TestCase):
         self.storage = FileSystemStorage(self.storage_dir)
 
     def tearDown(self):
+        self.storage.flush()
         shutil.rmtree(self.storage_dir)
 
     def _test_image_path(self, image_name):
@@ -36,6 +40,15 @@ class TestFileSystemStorage(unittest.TestCase):
             self.storage.save(image_name, image_extension, png_file.read())
         self.assertTrue(op.exists(file_path))
 
+    def test_add_image_from_file(self):
+        image_name = 'png_image'
+        image_extension = 'png'
+        with open(self._test_image_path('%s.%s' % (image_name, image_extension)), 'rb') as png_file:
+            self.storage.save_file(image_name, image_extension, png_file)
+            png_file.seek(0)
+            with self.storage.get(image_name, image_extension) as image_file:
+                self.assertEqual(png_file.read(), image_file.read())
+
     def test_read_image(self):
         image_name = 'png_image'
         image_extension = 'png'
@@ -54,10 +67,32 @@ class TestFileSystemStorage(unittest.TestCase):
         self.assertRaises(NotFound, self.storage.get, image_name, image_extension)
         self.assertRaises(NotFound, self.storage.get, image_name, image_extension, 'fit', (200, 200))
 
+    def test_try_get_not_existing(self):
+        image_name = 'png_image'
+        image_extension = 'png'
+        self.assertIsNone(self.storage.try_get(image_name, image_extension))
+        self.assertIsNone(self.storage.try_get(image_name, image_extension, 'fit', (200, 200)))
+        self.assertFalse(op.isdir(op.join(self.storage_dir, '_%s.%s' % (image_name, image_extension))))
+
+    def test_no_temporary_files_left(self):
+        image_name = 'png_image'
+        image_extension = 'png'
+        with open(self._test_image_path('%s.%s' % (image_name, image_extension)), 'rb') as png_file:
+            self.storage.save_file(image_name, image_extension, png_file)
+        self.storage.get(image_name, image_extension, 'fit', (200, 200))
+        self.storage.flush()
+        manipulated_directory = op.join(self.storage_dir, '_%s.%s' % (image_name, image_extension))
+        self.assertEqual(sorted(['.tmp', '%s.%s' % (image_name, image_extension),
+                                 '_%s.%s' % (image_name, image_extension)]),
+                         sorted(os.listdir(self.storage_dir)))
+        self.assertEqual([], os.listdir(op.join(self.storage_dir, '.tmp')))
+        self.assertEqual(['fit-200x200.%s' % image_extension], os.listdir(manipulated_directory))
+
     def test_illegal_mode(self):
         self.assertRaises(ValueError, self.storage.get, 'some', 'png', 'crop')
         self.assertRaises(ValueError, self.storage.get, 'some', 'png', None, (200, 200))
         self.assertRaises(ValueError, self.storage.get, 'some', 'png', 'notAllowed', (200, 200))
+        self.assertRaises(ValueError, self.storage.get, 'some', 'png', 'fit', (0, 200))
 
     def test_save_cropped_image(self):
         image_name = 'png_image'
@@ -90,6 +125,7 @@ class TestFileSystemStorage(unittest.TestCase):
         with open(self._test_image_path('%s.%s' % (image_name, image_extension)), 'rb') as png_file:
             self.storage.save(image_name, image_extension, png_file.read())
             image_file = self.storage.get(image_name, image_extension, mode, (200, 200))
+            self.storage.flush()
             file_name = '%s-%dx%d.png' % (mode, 200, 200)
             file_path = op.join(self.storage_dir, '_%s.%s/%s' % (image_name,
                                                                       image_extension,
@@ -105,6 +141,7 @@ class TestFileSystemStorage(unittest.TestCase):
         with open(self._test_image_path('%s.%s' % (image_name, image_extension)), 'rb') as png_file:
             self.storage.save(image_name, image_extension, png_file.read())
             image_file = self.storage.get(image_name, image_extension, mode, (200, 200))
+            self.storage.flush()
             file_name = '%s-%dx%d.png' % (mode, 200, 200)
             file_path = op.join(self.storage_dir, '_%s.%s/%s' % (image_name,
                                                                       image_extension,
@@ -113,6 +150,116 @@ class TestFileSystemStorage(unittest.TestCase):
             pil_image = PILImage.open(image_file)
             self.assertEqual((200, 150), pil_image.size)
 
+    def test_manipulate_replaced_original(self):
+        image_name = 'png_image'
+        image_extension = 'png'
+        with open(self._test_image_path('png_image.png'), 'rb') as png_file:
+            self.storage.save(image_name, image_extension, png_file.read())
+        image_file = self.storage.get(image_name, image_extension, 'fit', (1000, 1000))
+        self.assertEqual((640, 480), PILImage.open(image_file).size)
+        with open(self._test_image_path('jpg_image.jpg'), 'rb') as jpg_file:
+            self.storage.save(image_name, image_extension, jpg_file.read())
+        image_file = self.storage.get(image_name, image_extension, 'fit', (1000, 1000))
+        self.assertEqual((1000, 750), PILImage.open(image_file).size)
+
+    def _get_during(self, change_original, image_name, image_extension, mode, size):
+        """gets a manipulated image while change_original() runs between reading and
+           manipulating its original, then waits for the write-behind (which must be dropped).
+        """
+        manipulate = self.storage._manipulate
+        manipulating, changed = threading.Event(), threading.Event()
+
+        def blocking_manipulate(*args):
+            manipulating.set()
+            changed.wait()
+            return manipulate(*args)
+        self.storage._manipulate = blocking_manipulate
+        reader = threading.Thread(target=self.storage.get,
+                                  args=(image_name, image_extension, mode, size))
+        with self.assertLogs('image_service.storage', logging.INFO) as logs:
+            reader.start()
+            manipulating.wait()
+            self.storage._manipulate = manipulate
+            change_original()
+            changed.set()
+            reader.join()
+            self.storage.flush()
+        self.assertEqual([logging.INFO], [record.levelno for record in logs.records])
+        self.assertTrue(logs.records[0].getMessage().startswith('dropped outdated manipulated image'))
+        self.assertFalse(op.exists(op.join(self.storage_dir, '_%s.%s' % (image_name, image_extension))))
+        self.assertEqual([], os.listdir(op.join(self.storage_dir, '.tmp')))
+
+    def test_drop_manipulated_of_replaced_original(self):
+        image_name = 'png_image'
+        image_extension = 'png'
+        with open(self._test_image_path('png_image.png'), 'rb') as png_file:
+            self.storage.save(image_name, image_extension, png_file.read())
+        with open(self._test_image_path('jpg_image.jpg'), 'rb') as jpg_file:
+            replaced_image_data = jpg_file.read()
+        self._get_during(lambda: self.storage.save(image_name, image_extension, replaced_image_data),
+                         image_name, image_extension, 'fit', (1000, 1000))
+        self.assertFalse(self.storage.exists(image_name, image_extension, 'fit', (1000, 1000)))
+        image_file = self.storage.get(image_name, image_extension, 'fit', (1000, 1000))
+        self.assertEqual((1000, 750), PILImage.open(image_file).size)
+
+    def test_drop_manipulated_of_deleted_original(self):
+        image_name = 'png_image'
+        image_extension = 'png'
+        with open(self._test_image_path('png_image.png'), 'rb') as png_file:
+            self.storage.save(image_name, image_extension, png_file.read())
+        self._get_during(lambda: self.storage.delete(image_name, image_extension),
+                         image_name, image_extension, 'fit', (200, 200))
+        self.assertFalse(self.storage.exists(image_name, image_extension, 'fit', (200, 200)))
+        self.assertRaises(NotFound, self.storage.get, image_name, image_extension, 'fit', (200, 200))
+
+    def test_source_cache_max_file_size(self):
+        with open(self._test_image_path('png_image.png'), 'rb') as png_file:
+            binary_image_data = png_file.read()
+        storage = FileSystemStorage(self.storage_dir, source_cache_max_file_size=len(binary_image_data) - 1)
+        storage.save('png_image', 'png', binary_image_data)
+        storage.get('png_image', 'png', 'fit', (200, 200))
+        storage.flush()
+        self.assertNotIn(('png_image', 'png'), storage._source_cache)
+        storage = FileSystemStorage(self.storage_dir, source_cache_max_file_size=len(binary_image_data))
+        storage.get('png_image', 'png', 'fit', (100, 100))
+        storage.flush()
+        self.assertIn(('png_image', 'png'), storage._source_cache)
+
+    def test_regenerate(self):
+        image_name = 'png_image'
+        image_extension = 'png'
+        manipulated_directory = op.join(self.storage_dir, '_%s.%s' % (image_name, image_extension))
+        with open(self._test_image_path('png_image.png'), 'rb') as png_file:
+            self.storage.save(image_name, image_extension, png_file.read())
+        self.assertEqual(0, self.storage.regenerate(image_name, image_extension))
+        self.storage.get(image_name, image_extension, 'crop', (200, 200))
+        self.storage.get(image_name, image_extension, 'fit', (200, 200))
+        self.storage.flush()
+        with open(op.join(manipulated_directory, 'fit-200x200.png'), 'wb') as outdated_file:
+            outdated_file.write(b'outdated')
+        self.assertEqual(2, self.storage.regenerate(image_name, image_extension))
+        self.storage.flush()
+        with open(op.join(manipulated_directory, 'fit-200x200.png'), 'rb') as image_file:
+            self.assertEqual((200, 150), PILImage.open(image_file).size)
+        self.assertRaises(NotFound, self.storage.regenerate, 'not_existing', image_extension)
+
+    def test_preload(self):
+        with open(self._test_image_path('png_image.png'), 'rb') as png_file:
+            binary_image_data = png_file.read()
+        # modification times in a different order than the files are written
+        mtimes = {counter: 1000000000 + counter * 7 % 20 for counter in range(20)}
+        for counter, mtime in mtimes.items():
+            self.storage.save('png_image-%d' % counter, 'png', binary_image_data)
+            os.utime(op.join(self.storage_dir, 'png_image-%d.png' % counter), (mtime, mtime))
+        self.storage.get('png_image-0', 'png', 'fit', (200, 200))
+        self.storage.flush()
+        storage = FileSystemStorage(self.storage_dir, source_cache_size=4)
+        storage.preload()
+        # the 4 most recently changed originals, the most recent one used last
+        newest = sorted(mtimes, key=mtimes.get)[-4:]
+        self.assertEqual([('png_image-%d' % counter, 'png') for counter in newest],
+                         list(storage._source_cache._items))
+
     def test_delete_image(self):
         image_name = 'png_image'
         image_extension = 'png'
@@ -120,6 +267,7 @@ class TestFileSystemStorage(unittest.TestCase):
             self.storage.save(image_name, image_extension, png_file.read())
             self.storage.get(image_name, image_extension, 'crop', (200, 200))
             self.storage.get(image_name, image_extension, 'fit', (200, 200))
+            self.storage.flush()
             manipulated_directory = op.join(self.storage_dir,
                                                  '_%s.%s' % (image_name, image_extension))
             original_image_path = op.join(self.storage_dir,
@@ -148,6 +296,7 @@ class TestFileSystemStorage(unittest.TestCase):
         with open(self._test_image_path('%s.%s' % (image_name, image_extension)), 'rb') as png_file:
             self.storage.save(image_name, image_extension, png_file.read())
             self.storage.get(image_name, image_extension, mode, (200, 200))
+            self.storage.flush()
             self.assertTrue(op.isfile(file_path))
 
         with open(self._test_image_path('%s.%s' % (image_name, image_extension)), 'rb') as png_file: